@@ -2,13 +2,27 @@
 #!/usr/bin/env python3
 # export_h5_to_mhd.py
 # Minimal-dependency HDF5 -> MetaImage sequence exporter for fMRI time series.
-# Works with Python 3.9+; depends only on h5py & numpy.
+# Works with Python 3.9+; depends only on h5py & numpy (numba for the PSC kernel and tqdm for progress
+# are used if installed).
 
 import argparse, json, os, sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from pathlib import Path
 import numpy as np
 import h5py
 
+try:
+    from numba import njit, prange
+except ImportError:  # optional: fall back to plain NumPy
+    njit = None
+
+try:
+    from tqdm import tqdm
+except ImportError:  # optional: plain progress lines instead
+    tqdm = None
+
 EPS = 1e-6
 
 # ---------------- Utils ----------------
@@ -34,44 +48,153 @@ def find_4d_dataset(h: h5py.File, prefer_name_substrings=("bold", "timeseries",
     return name, ds
 
 
-def block_reduce_mean(vol, factor):
-    """Downsample (Z,Y,X) by integer factor using mean pooling; fallback to stride if not divisible."""
-    z, y, x = vol.shape
+def block_reduce_mean(vol, factor, out=None):
+    """Downsample (...,Z,Y,X) by integer factor using mean pooling; fallback to stride if not divisible.
+    Leading axes (e.g. a block of frames) are reduced in the same NumPy call.
+    If out is given (shape from downsampled_shape), the result is written there and returned."""
+    *lead, z, y, x = vol.shape
     f = factor
     if f <= 1:
-        return vol
+        if out is None:
+            return vol
+        out[...] = vol
+        return out
     if (z % f == 0) and (y % f == 0) and (x % f == 0):
-        vol = vol.reshape(z//f, f, y//f, f, x//f, f).mean(axis=(1,3,5))
+        n = len(lead)
+        vol = vol.reshape(*lead, z//f, f, y//f, f, x//f, f).mean(axis=(n+1, n+3, n+5), out=out)
         return vol
     # fallback: stride sampling (fast but not averaging)
-    return vol[::f, ::f, ::f]
+    if out is None:
+        return vol[..., ::f, ::f, ::f]
+    out[...] = vol[..., ::f, ::f, ::f]
+    return out
 
 
-def write_mhd_raw(out_dir: Path, frame_idx: int, vol_zyx_u8: np.ndarray):
-    """Write one frame as .mhd + .raw. Input vol is (Z,Y,X) uint8."""
-    assert vol_zyx_u8.dtype == np.uint8 and vol_zyx_u8.ndim == 3
-    Z, Y, X = vol_zyx_u8.shape
-    # MHD expects X Y Z order (x fastest). Reorder to (X,Y,Z) for C-ordered dump.
-    vol_xyz = np.ascontiguousarray(vol_zyx_u8.transpose(2,1,0))
+def percentiles(a, qs):
+    """np.percentile(a, qs) (linear interpolation), but selects the needed order statistics
+    with a single O(N) np.partition instead of sorting. Matches np.percentile for NaN-free
+    data; NaNs are partitioned to the end and count as the largest values, where
+    np.percentile would return nan."""
+    flat = np.ravel(a)
+    n = flat.size
+    pos = [q / 100.0 * (n - 1) for q in qs]
+    lo_k = [int(np.floor(p)) for p in pos]
+    hi_k = [min(k + 1, n - 1) for k in lo_k]
+    part = np.partition(flat, sorted(set(lo_k + hi_k)))
+    return [float(part[k0]) + (float(part[k1]) - float(part[k0])) * (p - k0)
+            for p, k0, k1 in zip(pos, lo_k, hi_k)]
+
+
+def downsampled_shape(shape, factor):
+    """Shape of block_reduce_mean(vol, factor) for a volume of the given (Z,Y,X) shape."""
+    f = factor
+    if f <= 1:
+        return tuple(shape)
+    if all(n % f == 0 for n in shape):
+        return tuple(n // f for n in shape)
+    return tuple(len(range(0, n, f)) for n in shape)
+
+
+def iter_slabs(ds: h5py.Dataset, t_axis: int, order_map, start: int, stop: int, n: int):
+    """Yield (t0, slab) over frames start..stop-1, slab being up to n frames as (n,Z,Y,X) float32
+    read straight from ds. Buffers are reused between slabs; copy a slab if you need to keep it."""
+    spatial_axes = [i for i in range(4) if i != t_axis]
+    # Axis order taking the on-disk slab to (t,Z,Y,X)
+    perm = [t_axis] + [spatial_axes[i] for i in order_map]
+    identity = perm == [0, 1, 2, 3]
+    bufs = {}
+    sel = [slice(None)] * 4
+    for t0 in range(start, stop, n):
+        k = min(n, stop - t0)
+        if k not in bufs:
+            native = tuple(k if i == t_axis else int(s) for i, s in enumerate(ds.shape))
+            raw = np.empty(native, dtype=np.float32)
+            buf = raw if identity else np.empty(tuple(native[i] for i in perm), dtype=np.float32)
+            bufs[k] = (raw, buf)
+        raw, buf = bufs[k]
+        sel[t_axis] = slice(t0, t0 + k)
+        ds.read_direct(raw, tuple(sel))
+        if not identity:
+            np.copyto(buf, raw.transpose(perm))
+        yield t0, buf
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _psc_to_u8_kernel(data, baseline, inv_baseline, cmin, cmax, scale, out):
+        T, Z, Y, X = data.shape
+        for t in prange(T):
+            for z in range(Z):
+                for y in range(Y):
+                    for x in range(X):
+                        v = 100.0 * (data[t, z, y, x] - baseline[z, y, x]) * inv_baseline[z, y, x]
+                        v = min(max(v, cmin), cmax)
+                        out[t, z, y, x] = np.uint8((v - cmin) * scale + 0.5)
+
+
+def psc_to_u8(data, baseline, inv_baseline, cmin, cmax, out=None):
+    """Percent signal change of (n,Z,Y,X) frames vs a (Z,Y,X) baseline, clamped to [cmin,cmax] and
+    mapped to uint8. Runs as one fused pass with numba, otherwise as a chain of NumPy ops."""
+    if out is None:
+        out = np.empty(data.shape, dtype=np.uint8)
+    scale = 255.0 / max(cmax - cmin, EPS)
+    if njit is not None:
+        # The kernel walks memory linearly; strided views (e.g. the stride-downsample fallback or a
+        # transposed read) would hit its slow path, so pay one copy up front instead (no-op if already C-ordered).
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        _psc_to_u8_kernel(data, baseline, inv_baseline, float(cmin), float(cmax), scale, out)
+        return out
+    psc = (data - baseline) * inv_baseline * 100.0  # percent signal change
+    np.clip(psc, cmin, cmax, out=psc)
+    # psc is already within [cmin,cmax], so the scaled value is within [0,255]: round and cast, no second clip
+    psc -= cmin
+    psc *= scale
+    psc += 0.5
+    out[...] = psc
+    return out
 
-    raw_name = f"frame_{frame_idx:04d}.raw"
-    mhd_name = f"frame_{frame_idx:04d}.mhd"
 
-    with open(out_dir / raw_name, "wb") as f:
-        f.write(vol_xyz.tobytes(order="C"))
+def write_buffer(path: Path, arr: np.ndarray):
+    """Write the bytes of a contiguous array to path with raw os.write calls (no file object, no tobytes copy)."""
+    view = memoryview(np.ascontiguousarray(arr)).cast("B")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
 
-    header = (
+
+def mhd_header_template(X: int, Y: int, Z: int) -> str:
+    """MHD header for a (Z,Y,X) uint8 frame; only '{raw_name}' is left to fill in per frame."""
+    return (
         "ObjectType = Image\n"
         "NDims = 3\n"
         f"DimSize = {X} {Y} {Z}\n"
         "ElementType = MET_UCHAR\n"
         "ElementSpacing = 1 1 1\n"
         "ElementByteOrderMSB = False\n"
-        f"ElementDataFile = {raw_name}\n"
+        "ElementDataFile = {raw_name}\n"
+        "\n"
     )
 
+
+def write_mhd_raw(out_dir: Path, frame_idx: int, vol_zyx_u8: np.ndarray, header_template: str = None):
+    """Write one frame as .mhd + .raw. Input vol is (Z,Y,X) uint8.
+    Pass header_template (from mhd_header_template) to reuse one header across frames."""
+    assert vol_zyx_u8.dtype == np.uint8 and vol_zyx_u8.ndim == 3
+    # MHD expects X Y Z order (x fastest), which is exactly a C-ordered (Z,Y,X) array: dump it as-is.
+    if header_template is None:
+        Z, Y, X = vol_zyx_u8.shape
+        header_template = mhd_header_template(X, Y, Z)
+
+    raw_name = f"frame_{frame_idx:04d}.raw"
+    mhd_name = f"frame_{frame_idx:04d}.mhd"
+
+    write_buffer(out_dir / raw_name, vol_zyx_u8)
+
     with open(out_dir / mhd_name, "w") as f:
-            f.write(header + "\n")
+            f.write(header_template.format(raw_name=raw_name))
 
 
 # ---------------- Export logic ----------------
@@ -88,6 +211,8 @@ def main():
     p.add_argument("--clamp", default="-5,5", help="PSC clamp range as 'min,max' (e.g., '-5,5')")
     p.add_argument("--downsample", type=int, default=2, help="Integer spatial downsample (default 2)")
     p.add_argument("--dtype", choices=["u8"], default="u8", help="Output dtype (only u8 supported here)")
+    p.add_argument("--frames_per_read", type=int, default=16, help="Frames read and downsampled per HDF5 read")
+    p.add_argument("--write_threads", type=int, default=8, help="Threads writing frames to disk")
     p.add_argument("--tr", type=float, default=None, help="TR seconds (optional; saved to manifest)")
 
     args = p.parse_args()
@@ -96,7 +221,8 @@ def main():
     out_dir = Path(args.outdir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    with h5py.File(h5_path, "r") as h:
+    # Large chunk cache so consecutive frame reads reuse decompressed chunks
+    with h5py.File(h5_path, "r", rdcc_nbytes=256 << 20, rdcc_nslots=1_000_003) as h:
         if args.dataset is None:
             ds_name, ds = find_4d_dataset(h)
         else:
@@ -110,68 +236,101 @@ def main():
         if t_axis < 0 or t_axis > 3:
             raise ValueError("time_axis must be 0..3")
 
-        # Move time axis to axis 0, spatial axes to (Z,Y,X) afterwards
+        # Work out the layout from the dataset shape alone; frames are read one at a time below.
         # We prefer spatial order (Z,Y,X) internally.
-        perm = [t_axis] + [i for i in range(4) if i != t_axis]
-        data = np.asarray(ds, dtype=np.float32).transpose(perm)
-        T, A, B, C = data.shape
+        T = shape[t_axis]
+        A, B, C = [shape[i] for i in range(4) if i != t_axis]
 
         # Heuristic to map (A,B,C) -> (Z,Y,X): assume X and Y are similar (~64-128), Z is smaller (~30-60)
         spatial = np.array([A,B,C])
         z_idx = int(np.argmin(spatial))  # often Z has the smallest extent
         order_map = [z_idx] + [i for i in range(3) if i != z_idx]
-        Z, Y, X = spatial[order_map]
+        Z, Y, X = (int(n) for n in spatial[order_map])
 
         print(f"Interpreted spatial dims as Z,Y,X = {Z},{Y},{X}")
 
-        # Reorder to (T,Z,Y,X)
-        data = data.transpose([0, 1+order_map[0], 1+order_map[1], 1+order_map[2]])
-
-        # Downsample spatially
-        if args.downsample and args.downsample > 1:
-            f = int(args.downsample)
-            ds_vols = np.empty((T, 0, 0, 0), dtype=np.float32)  # placeholder for shape introspection
-            downs = []
-            for t in range(T):
-                vol = data[t]
-                vol = block_reduce_mean(vol, f)
-                downs.append(vol)
-            data = np.stack(downs, axis=0)
-            T, Z, Y, X = data.shape
-            print(f"Downsampled to (T,Z,Y,X) = {data.shape}")
+        # Spatial downsample is applied to each slab of frames as it is read
+        f = int(args.downsample) if args.downsample else 1
+        if f > 1:
+            Z, Y, X = downsampled_shape((Z, Y, X), f)
+            print(f"Downsampling to (T,Z,Y,X) = {(T, Z, Y, X)}")
+        n_read = max(1, int(args.frames_per_read))
+
+        def slabs(start, stop, into=None):
+            """Downsampled (n,Z,Y,X) slabs; written into into[t0:t0+n] if given, else a reused buffer."""
+            down = np.empty((n_read, Z, Y, X), dtype=np.float32) if f > 1 else None
+            for t0, slab in iter_slabs(ds, t_axis, order_map, start, stop, n_read):
+                k = len(slab)
+                dst = into[t0:t0 + k] if into is not None else (down[:k] if down is not None else None)
+                yield t0, block_reduce_mean(slab, f, out=dst)
 
         # Normalize to uint8 per mode
         if args.mode == "psc":
             N = int(args.baselineN)
             if N <= 0 or N > T:
                 raise ValueError("baselineN must be in 1..T")
-            baseline = data[:N].mean(axis=0, keepdims=True)
+            # First pass: read the first N frames once and keep them (the second pass starts from
+            # them and only reads N..T-1); the baseline is their mean, accumulated in float64
+            held = np.empty((N, Z, Y, X), dtype=np.float32)
+            for _ in slabs(0, N, into=held):
+                pass
+            baseline = (np.add.reduce(held, axis=0, dtype=np.float64) / N).astype(np.float32)
             baseline = np.where(np.abs(baseline) < EPS, EPS, baseline)
-            psc = 100.0 * (data - baseline) / baseline  # percent signal change
+            inv_baseline = 1.0 / baseline
             cmin, cmax = [float(x) for x in args.clamp.split(",")]
-            psc = np.clip(psc, cmin, cmax)
-            # map [-|cmin|, |cmax|] → [0,1], center at 0.5
-            vmin, vmax = cmin, cmax
-            norm = (psc - vmin) / max(vmax - vmin, EPS)
-            u8 = np.clip(norm * 255.0, 0, 255).astype(np.uint8)
+
+            # map [-|cmin|, |cmax|] → [0,255], center at 127.5
+            def to_u8(vol):
+                return psc_to_u8(vol, baseline, inv_baseline, cmin, cmax)
+
             out_mode = "psc"
             clamp_tuple = [cmin, cmax]
         else:
-            # raw: global min/max (robust percentiles to avoid outliers)
-            lo = float(np.percentile(data, 1))
-            hi = float(np.percentile(data, 99))
-            data = np.clip(data, lo, hi)
-            norm = (data - lo) / max(hi - lo, EPS)
-            u8 = np.clip(norm * 255.0, 0, 255).astype(np.uint8)
+            # raw: global min/max (robust percentiles to avoid outliers), needs every frame up front
+            held = np.empty((T, Z, Y, X), dtype=np.float32)
+            for _ in slabs(0, T, into=held):
+                pass
+            lo, hi = percentiles(held, [1, 99])
+
+            def to_u8(vol):
+                # clipped to [lo,hi] first, so the scaled value is already within [0,255]
+                vol = np.clip(vol, lo, hi)
+                return ((vol - lo) * (255.0 / max(hi - lo, EPS)) + 0.5).astype(np.uint8)
+
             out_mode = "raw"
             clamp_tuple = [lo, hi]
 
-        # Write frames
-        for t in range(T):
-            write_mhd_raw(out_dir, t, u8[t])  # (Z,Y,X) u8
-            if t % 10 == 0:
+        # Second pass: convert the frames held from the first pass, then read the rest and
+        # convert and write each slab as soon as it is read
+        n_held = len(held)
+        src = chain(((t0, held[t0:t0 + n_read]) for t0 in range(0, n_held, n_read)), slabs(n_held, T))
+        # Frames are written from a thread pool so disk I/O overlaps with converting the next slab.
+        # Pending writes are capped so finished u8 slabs can be freed.
+        pending = deque()
+        header_template = mhd_header_template(X, Y, Z)
+        # Progress: a throttled tqdm bar if available, else a line every ~10% of frames
+        progress = tqdm(total=T, unit="frame", desc="Writing") if tqdm is not None else None
+        report_every = max(1, T // 10)
+
+        def finish(t, fut):
+            fut.result()
+            if progress is not None:
+                progress.update(1)
+            elif (t + 1) % report_every == 0 or t + 1 == T:
                 print(f"Wrote frame {t+1}/{T}")
 
+        with ThreadPoolExecutor(max_workers=max(1, int(args.write_threads))) as ex:
+            for t0, slab in src:
+                u8 = to_u8(slab)  # fresh (n,Z,Y,X) u8, kept alive by the queued writes
+                for i in range(len(u8)):
+                    pending.append((t0 + i, ex.submit(write_mhd_raw, out_dir, t0 + i, u8[i], header_template)))
+                while len(pending) > 2 * max(n_read, args.write_threads):
+                    finish(*pending.popleft())
+            for t, fut in pending:
+                finish(t, fut)
+        if progress is not None:
+            progress.close()
+
         # Manifest (ensure pure Python types for json)
         manifest = {
             "n_frames": int(T),
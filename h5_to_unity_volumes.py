@@ -4,6 +4,11 @@ import os, json, argparse, math
 import numpy as np
 import h5py
 
+try:
+    from numba import njit, prange
+except ImportError:  # optional: fall back to plain NumPy
+    njit = None
+
 def find_4d_dataset(h5):
     best = None
     best_size = -1
@@ -18,43 +23,121 @@ def find_4d_dataset(h5):
         raise RuntimeError("No 4D numeric dataset found (need T×X×Y×Z).")
     return best
 
+def percentiles(a, qs):
+    """np.percentile(a, qs) (linear interpolation), but selects the needed order statistics
+    with a single O(N) np.partition instead of sorting. Matches np.percentile for NaN-free
+    data; NaNs are partitioned to the end and count as the largest values, where
+    np.percentile would return nan."""
+    flat = np.ravel(a)
+    n = flat.size
+    pos = [q / 100.0 * (n - 1) for q in qs]
+    lo_k = [int(np.floor(p)) for p in pos]
+    hi_k = [min(k + 1, n - 1) for k in lo_k]
+    part = np.partition(flat, sorted(set(lo_k + hi_k)))
+    return [float(part[k0]) + (float(part[k1]) - float(part[k0])) * (p - k0)
+            for p, k0, k1 in zip(pos, lo_k, hi_k)]
+
 def percentile_window(a, lo=2.0, hi=98.0):
-    lo_v = np.percentile(a, lo)
-    hi_v = np.percentile(a, hi)
+    lo_v, hi_v = percentiles(a, [lo, hi])
     if hi_v <= lo_v:
         hi_v = lo_v + 1e-6
     return lo_v, hi_v
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _to_uint8_kernel(vol, vmin, scale, out):
+        for i in prange(vol.size):
+            v = (vol[i] - vmin) * scale
+            v = 0.0 if v < 0.0 else (1.0 if v > 1.0 else v)
+            out[i] = np.uint8(v * 255.0 + 0.5)
+
 def to_uint8(volume, vmin, vmax):
+    """Map [vmin,vmax] -> [0,255] with clipping."""
+    out = np.empty(volume.shape, dtype=np.uint8)
+    if njit is not None:
+        # single fused pass (normalize + clip + round + cast), no float temporaries
+        _to_uint8_kernel(np.ravel(volume), float(vmin), 1.0 / (vmax - vmin), out.reshape(-1))
+        return out
     v = np.clip((volume - vmin) / (vmax - vmin), 0, 1)
-    return (v * 255.0 + 0.5).astype(np.uint8)
+    out[...] = v * 255.0 + 0.5
+    return out
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _psc_to_uint8_kernel(data, baseline, inv_b, gain, out):
+        T, X, Y, Z = data.shape
+        for t in prange(T):
+            for x in range(X):
+                for y in range(Y):
+                    for z in range(Z):
+                        v = (data[t, x, y, z] - baseline[x, y, z]) * inv_b[x, y, z] * gain + 127.5
+                        v = 0.0 if v < 0.0 else (255.0 if v > 255.0 else v)
+                        out[t, x, y, z] = np.uint8(v + 0.5)
+
+def psc_to_uint8(data, baseline, psc_range, eps=1e-6):
+    """
+    data: (T, X, Y, Z), baseline: (X, Y, Z)
+    PSC = 100*(data-baseline)/(baseline+eps), with [-psc_range, +psc_range] mapped to [0,255]
+    (same values as to_uint8 on the clipped [0,1] PSC), computed without any float PSC arrays.
+    """
+    inv_b = (1.0 / (baseline + eps)).astype(np.float32)  # avoid div-by-zero
+    gain = 100.0 * 255.0 / (2 * psc_range)
+    out = np.empty(data.shape, dtype=np.uint8)
+    if njit is not None:
+        # one up-front copy if data is a strided view, so the kernel reads memory linearly;
+        # float16 data (--float16) is widened a few frames at a time since numba has no half type
+        baseline = np.ascontiguousarray(baseline)
+        step = len(data) if data.dtype == np.float32 else 16
+        for t0 in range(0, len(data), step):
+            block = np.ascontiguousarray(data[t0:t0 + step], dtype=np.float32)
+            _psc_to_uint8_kernel(block, baseline, inv_b, gain, out[t0:t0 + step])
+        return out
+    # frame by frame so the float temporaries stay one volume in size
+    for t in range(len(data)):
+        v = (data[t] - baseline) * inv_b
+        v *= gain
+        v += 127.5
+        np.clip(v, 0.0, 255.0, out=v)
+        v += 0.5
+        out[t] = v
+    return out
+
+def _true_extent(line):
+    """(first, last+1) index of True in a 1D bool array that has at least one True."""
+    return int(np.argmax(line)), len(line) - int(np.argmax(line[::-1]))
 
-def crop_and_center(vol4d, thresh=0.05):
+def crop_and_center(vol4d, thresh=0.05, mean_vol=None):
     """
     vol4d: (T, X, Y, Z) in [0,1] float
     1) Build a mask from the mean volume > thresh
     2) Compute bounding box, crop
     3) Symmetrically pad to center the brain in the crop box
-    Returns cropped+centered vol4d and crop/pad info.
+    mean_vol: precomputed time-mean of vol4d (computed here if None)
+    Returns cropped+centered vol4d and crop/pad info; apply_crop() repeats it on other volumes.
     """
-    mean_vol = vol4d.mean(axis=0)  # (X,Y,Z)
+    if mean_vol is None:
+        mean_vol = vol4d.mean(axis=0)  # (X,Y,Z)
     mask = mean_vol > thresh
     if not mask.any():
         # nothing crosses threshold -> do nothing
         return vol4d, dict(cropped=False)
-    coords = np.argwhere(mask)
-    (x0,y0,z0) = coords.min(axis=0)
-    (x1,y1,z1) = coords.max(axis=0) + 1
-    vol4d = vol4d[:, x0:x1, y0:y1, z0:z1]
+    # Bounding box from per-axis projections (no list of every masked voxel's coordinates)
+    (x0,x1), (y0,y1), (z0,z1) = [_true_extent(np.any(mask, axis=ax)) for ax in ((1,2), (0,2), (0,1))]
     # Center by symmetric padding to closest cube-ish shape? We’ll only center, not force cube.
-    X, Y, Z = vol4d.shape[1:]
     # Find COM and pad so COM sits near center (approximate by equal padding each side)
     # Simpler: just pad to equalize dimensions parity and ensure even margins.
     # Here we’ll just pad 2 voxels each side as a small margin.
-    pad = [(0,0), (2,2), (2,2), (2,2)]
-    vol4d = np.pad(vol4d, pad_width=pad, mode='constant', constant_values=0.0)
     info = dict(cropped=True, x0=int(x0),y0=int(y0),z0=int(z0),x1=int(x1),y1=int(y1),z1=int(z1),pad=2)
-    return vol4d, info
+    return apply_crop(vol4d, info), info
+
+def apply_crop(vol, info):
+    """Crop + pad the trailing (X,Y,Z) axes of vol as described by crop_and_center's info."""
+    if not info.get("cropped"):
+        return vol
+    vol = vol[..., info["x0"]:info["x1"], info["y0"]:info["y1"], info["z0"]:info["z1"]]
+    p = info["pad"]
+    pad = [(0,0)] * (vol.ndim - 3) + [(p,p), (p,p), (p,p)]
+    return np.pad(vol, pad_width=pad, mode='constant', constant_values=0.0)
 
 def main():
     ap = argparse.ArgumentParser(description="Export fMRI HDF5 (T×X×Y×Z) to Unity .vol frames + manifest.json")
@@ -67,34 +150,47 @@ def main():
     ap.add_argument("--downsample", type=int, default=1, help="Integer downsample factor (1=no downsample)")
     ap.add_argument("--tr", type=float, default=None, help="Override TR seconds (if unknown)")
     ap.add_argument("--no_psc", action="store_true", help="Skip PSC export (raw/mean anatomy only)")
+    ap.add_argument("--float16", action="store_true",
+                    help="Hold the normalized series as float16 (half the memory; PSC may shift by ~1 level)")
     args = ap.parse_args()
 
     os.makedirs(args.outdir, exist_ok=True)
 
-    with h5py.File(args.h5_path, "r") as h5:
+    # Large chunk cache so per-frame reads reuse decompressed chunks
+    with h5py.File(args.h5_path, "r", rdcc_nbytes=256 << 20, rdcc_nslots=1_000_003) as h5:
         ds = find_4d_dataset(h5)
-        data = ds[()]  # shape unknown order; expect (T,X,Y,Z) or (X,Y,Z,T). We’ll normalize to (T,X,Y,Z).
-        shp = data.shape
+        # shape unknown order; expect (T,X,Y,Z) or (X,Y,Z,T). We’ll normalize to (T,X,Y,Z).
+        # The time axis is decided from the shape alone, before anything is read.
+        shp = tuple(int(s) for s in ds.shape)
         # Heuristics: if first dim is smallest (<10?) assume it's Z or X; most BOLD have T ~100-300
         # Typical: (T,X,Y,Z) has T ~ 150-300, X,Y,Z ~ 64-ish.
         if shp[0] < 16 and shp[-1] > 32:
-            # assume (X,Y,Z,T) -> roll last to first
-            data = np.moveaxis(data, -1, 0)  # (T,X,Y,Z)
+            # assume (X,Y,Z,T)
+            t_axis = 3
         elif shp[0] >= 16 and shp[-1] < 16:
             # assume already (T,X,Y,Z)
-            pass
+            t_axis = 0
         else:
             # choose the axis with largest size as T
-            t_axis = int(np.argmax(shp))
-            if t_axis != 0:
-                data = np.moveaxis(data, t_axis, 0)
+            t_axis = shp.index(max(shp))
 
-        T, X, Y, Z = data.shape
-        # optional integer downsample
-        if args.downsample > 1:
-            f = args.downsample
-            data = data[:, ::f, ::f, ::f]
-            T, X, Y, Z = data.shape
+        # optional integer downsample, applied by the HDF5 selection itself
+        f = max(1, args.downsample)
+        T = shp[t_axis]
+        X, Y, Z = [len(range(0, n, f)) for i, n in enumerate(shp) if i != t_axis]
+
+        # Read straight into a (T,X,Y,Z) float32 buffer (HDF5 converts on the fly, no on-disk-dtype
+        # copy and no moveaxis copy afterwards)
+        data = np.empty((T, X, Y, Z), dtype=np.float32)
+        sel = [slice(None, None, f)] * 4
+        sel[t_axis] = slice(None)
+        if t_axis == 0:
+            ds.read_direct(data, tuple(sel))
+        else:
+            # time is not the leading axis: read frame by frame into data[t]
+            for t in range(T):
+                sel[t_axis] = t
+                ds.read_direct(data, tuple(sel), np.s_[t])
 
         # TR guess
         tr = args.tr
@@ -118,17 +214,27 @@ def main():
         # Robust intensity window on the whole timeseries
         lo, hi = percentile_window(data, 2.0, 98.0)
         data_norm = (data - lo) / (hi - lo)
-        data_norm = np.clip(data_norm, 0.0, 1.0).astype(np.float32)
+        data_norm = np.clip(data_norm, 0.0, 1.0).astype(np.float16 if args.float16 else np.float32)
+
+        # One pass over time for every mean we need: the full time-mean (crop mask + anatomy,
+        # and PSC baseline for baseline=mean) and the first-N mean (PSC baseline for firstN).
+        # Both commute with the crop/pad, so they are cropped afterwards instead of recomputed.
+        N = max(1, min(args.baselineN, T))
+        sum_vol = np.zeros((X, Y, Z), dtype=np.float64)
+        sumN_vol = None
+        for t in range(T):
+            sum_vol += data_norm[t]
+            if t == N - 1:
+                sumN_vol = sum_vol.copy()
+        mean_vol = (sum_vol / T).astype(np.float32)  # (X,Y,Z)
 
         # (Optional) crop + center
         if args.crop_center:
-            data_norm, cropinfo = crop_and_center(data_norm, thresh=0.05)
+            data_norm, cropinfo = crop_and_center(data_norm, thresh=0.05, mean_vol=mean_vol)
             T, X, Y, Z = data_norm.shape
         else:
             cropinfo = dict(cropped=False)
-
-        # Mean anatomy (time-mean)
-        mean_vol = data_norm.mean(axis=0)  # (X,Y,Z)
+        mean_vol = apply_crop(mean_vol, cropinfo)
 
         # Write anatomy (time-mean) as 8-bit .vol
         anatomy_u8 = to_uint8(mean_vol, 0.0, 1.0)
@@ -141,25 +247,18 @@ def main():
         # PSC
         if not args.no_psc:
             if args.baseline == "firstN":
-                N = max(1, min(args.baselineN, T))
-                baseline = data_norm[:N].mean(axis=0)
+                baseline = apply_crop((sumN_vol / N).astype(np.float32), cropinfo)
             else:
-                baseline = data_norm.mean(axis=0)
-
-            # Avoid div-by-zero
-            eps = 1e-6
-            # PSC percent
-            psc = 100.0 * (data_norm - baseline[None, ...]) / (baseline[None, ...] + eps)  # (T,X,Y,Z)
+                baseline = mean_vol
 
-            # Map PSC to [0,1] by +/- psc_range
-            pr = float(args.psc_range)
-            psc01 = np.clip((psc + pr) / (2*pr), 0.0, 1.0).astype(np.float32)
+            # PSC percent, +/- psc_range mapped straight to uint8 (T,X,Y,Z)
+            psc_u8 = psc_to_uint8(data_norm, baseline, float(args.psc_range))
 
             # Write PSC frames as uint8
             for t in range(T):
                 fname = f"psc_{t:04d}.vol"
                 path = os.path.join(args.outdir, fname)
-                to_uint8(psc01[t], 0.0, 1.0).tofile(path)
+                psc_u8[t].tofile(path)
                 psc_frames.append(dict(file=fname, t=t))
 
         # Also (optional) write raw frames (normalized) if you want to scrub them instead of mean anatomy
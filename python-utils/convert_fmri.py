@@ -4,7 +4,8 @@ import h5py
 from pathlib import Path
 import os
 
-def process_fmri_to_hdf5(nifti_filepath, output_filepath=None, n_print_slices=5, compression='gzip'):
+def process_fmri_to_hdf5(nifti_filepath, output_filepath=None, n_print_slices=5, compression='gzip',
+                         compression_opts=1, shuffle=True, fletcher32=False, verbose=False):
     """
     Load 4D fMRI NIfTI data, print first n time slices, and save as HDF5 format
     
@@ -13,6 +14,10 @@ def process_fmri_to_hdf5(nifti_filepath, output_filepath=None, n_print_slices=5,
     output_filepath (str): Path for output HDF5 file (optional, auto-generated if None)
     n_print_slices (int): Number of time slices to print for inspection
     compression (str): HDF5 compression method ('gzip', 'lzf', 'szip', or None)
+    compression_opts (int): gzip level (ignored for other methods); 1 is much faster than 9 for ~1% larger files
+    shuffle (bool): Apply the byte-shuffle filter before compressing
+    fletcher32 (bool): Store a checksum per chunk (costs a checksum pass on every read and write)
+    verbose (bool): Also print a 5x5 sample of raw values from the center of each printed slice
     
     Returns:
     str: Path to the saved HDF5 file
@@ -23,7 +28,8 @@ def process_fmri_to_hdf5(nifti_filepath, output_filepath=None, n_print_slices=5,
     # Load the NIfTI file
     try:
         img = nib.load(nifti_filepath)
-        data = img.get_fdata()
+        # float32 straight from nibabel (scaling applied in float32, no cached float64 copy)
+        data = img.get_fdata(dtype=np.float32, caching='unchanged')
         header = img.header
         affine = img.affine
         
@@ -52,15 +58,16 @@ def process_fmri_to_hdf5(nifti_filepath, output_filepath=None, n_print_slices=5,
         print(f"  Shape: {time_slice.shape}")
         print(f"  Min: {np.min(time_slice):.6f}")
         print(f"  Max: {np.max(time_slice):.6f}")
-        print(f"  Mean: {np.mean(time_slice):.6f}")
-        print(f"  Std: {np.std(time_slice):.6f}")
+        print(f"  Mean: {np.mean(time_slice, dtype=np.float64):.6f}")
+        print(f"  Std: {np.std(time_slice, dtype=np.float64):.6f}")
         print(f"  Non-zero voxels: {np.count_nonzero(time_slice)}")
         
         # Print a small sample of values from the center of the brain
-        center_x, center_y, center_z = x_size//2, y_size//2, z_size//2
-        sample_region = time_slice[center_x-2:center_x+3, center_y-2:center_y+3, center_z]
-        print(f"  Sample values (center slice at z={center_z}):")
-        print(f"    {sample_region}")
+        if verbose:
+            center_x, center_y, center_z = x_size//2, y_size//2, z_size//2
+            sample_region = time_slice[center_x-2:center_x+3, center_y-2:center_y+3, center_z]
+            print(f"  Sample values (center slice at z={center_z}):")
+            print(f"    {sample_region}")
     
     # Reshape data from (x,y,z,t) to (t,x,y,z)
     print(f"\nReshaping data from {data.shape} to ({t_size}, {x_size}, {y_size}, {z_size})")
@@ -82,12 +89,19 @@ def process_fmri_to_hdf5(nifti_filepath, output_filepath=None, n_print_slices=5,
         with h5py.File(output_filepath, 'w') as hf:
             # Save the main data array
             if compression:
+                # One chunk per time point so a per-frame read (ds[t]) decompresses exactly one chunk;
+                # split along x if a frame is bigger than ~4 MB
+                frame_bytes = x_size * y_size * z_size * data_reshaped.dtype.itemsize
+                x_chunk = x_size
+                while x_chunk > 1 and frame_bytes * x_chunk // x_size > 4 * 1024**2:
+                    x_chunk = (x_chunk + 1) // 2
                 dataset = hf.create_dataset('fmri_data', 
                                           data=data_reshaped, 
+                                          chunks=(1, x_chunk, y_size, z_size),
                                           compression=compression,
-                                          compression_opts=9 if compression=='gzip' else None,
-                                          shuffle=True,
-                                          fletcher32=True)
+                                          compression_opts=compression_opts if compression=='gzip' else None,
+                                          shuffle=shuffle,
+                                          fletcher32=fletcher32)
             else:
                 dataset = hf.create_dataset('fmri_data', data=data_reshaped)
             
@@ -112,10 +126,10 @@ def process_fmri_to_hdf5(nifti_filepath, output_filepath=None, n_print_slices=5,
             
             # Calculate and save some basic statistics
             stats_group = hf.create_group('statistics')
-            stats_group.create_dataset('mean_timeseries', data=np.mean(data_reshaped, axis=(1,2,3)))
-            stats_group.create_dataset('std_timeseries', data=np.std(data_reshaped, axis=(1,2,3)))
-            stats_group.create_dataset('global_mean', data=np.mean(data_reshaped))
-            stats_group.create_dataset('global_std', data=np.std(data_reshaped))
+            stats_group.create_dataset('mean_timeseries', data=np.mean(data_reshaped, axis=(1,2,3), dtype=np.float64))
+            stats_group.create_dataset('std_timeseries', data=np.std(data_reshaped, axis=(1,2,3), dtype=np.float64))
+            stats_group.create_dataset('global_mean', data=np.mean(data_reshaped, dtype=np.float64))
+            stats_group.create_dataset('global_std', data=np.std(data_reshaped, dtype=np.float64))
             
         print(f"Successfully saved HDF5 file!")
         
@@ -147,7 +161,7 @@ def load_and_inspect_hdf5(hdf5_filepath, n_inspect_slices=3):
     print(f"\n=== Inspecting HDF5 file: {hdf5_filepath} ===")
     
     try:
-        with h5py.File(hdf5_filepath, 'r') as hf:
+        with h5py.File(hdf5_filepath, 'r', rdcc_nbytes=64 * 1024**2) as hf:
             # Print file structure
             print("File structure:")
             def print_structure(name, obj):
@@ -157,10 +171,10 @@ def load_and_inspect_hdf5(hdf5_filepath, n_inspect_slices=3):
             
             hf.visititems(print_structure)
             
-            # Load the main dataset
-            fmri_data = hf['fmri_data'][:]
-            print(f"\nLoaded fMRI data shape: {fmri_data.shape}")
-            print(f"Data type: {fmri_data.dtype}")
+            # Open the main dataset (data stays on disk; only the inspected slices are read)
+            fmri_ds = hf['fmri_data']
+            print(f"\nLoaded fMRI data shape: {fmri_ds.shape}")
+            print(f"Data type: {fmri_ds.dtype}")
             
             # Print attributes
             print(f"\nDataset attributes:")
@@ -168,9 +182,9 @@ def load_and_inspect_hdf5(hdf5_filepath, n_inspect_slices=3):
                 print(f"  {key}: {value}")
             
             # Inspect first few time slices
-            print(f"\n=== Inspecting first {min(n_inspect_slices, fmri_data.shape[0])} time slices from HDF5 ===")
-            for t in range(min(n_inspect_slices, fmri_data.shape[0])):
-                time_slice = fmri_data[t, :, :, :]
+            print(f"\n=== Inspecting first {min(n_inspect_slices, fmri_ds.shape[0])} time slices from HDF5 ===")
+            for t in range(min(n_inspect_slices, fmri_ds.shape[0])):
+                time_slice = fmri_ds[t, :, :, :]
                 print(f"\nTime slice {t} from HDF5:")
                 print(f"  Shape: {time_slice.shape}")
                 print(f"  Min: {np.min(time_slice):.6f}")
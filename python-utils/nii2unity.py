@@ -2,9 +2,31 @@ import nibabel as nib
 import numpy as np
 import scipy.io as sio
 import json
+import os
+import gzip
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-def load_and_convert_nifti(filepath, n_preview=5, output_dir=None):
+try:
+    from numba import njit, prange
+except ImportError:  # optional: fall back to plain NumPy
+    njit = None
+
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib json module
+    orjson = None
+
+try:
+    import blosc2
+except ImportError:  # optional: only needed for compress=True
+    blosc2 = None
+
+def load_and_convert_nifti(filepath, n_preview=5, output_dir=None, write_npy=True, write_mat=False,
+                           write_bytes=True, write_unity_script=True, compress=False):
     """
     Load NIfTI fMRI data, preview first n time slices, and save as Unity-compatible 4D format
     
@@ -12,21 +34,72 @@ def load_and_convert_nifti(filepath, n_preview=5, output_dir=None):
     filepath (str): Path to the .nii or .nii.gz file
     n_preview (int): Number of time slices to preview
     output_dir (str): Directory to save output files (default: same as input file)
+    write_npy (bool): Write the .npy file (default: True)
+    write_mat (bool): Also write a MATLAB .mat copy of the data (default: False)
+    write_bytes (bool): Write the raw float32 .bytes file the Unity loader reads (default: True)
+    write_unity_script (bool): Generate the FMRILoader C# script (default: True)
+    compress (bool): Write the .npy data as a blosc2 (LZ4 + shuffle) .b2nd file instead
+                     (needs the blosc2 package; default: False)
     
     Returns:
-    np.ndarray: 4D array with shape (t, x, y, z)
+    np.ndarray: 4D array with shape (t, x, y, z) (a blosc2 NDArray with compress=True
+                and write_bytes=False)
     """
     
-    # Load the NIfTI file
+    # A .nii.gz is decompressed once to a temporary .nii so every timepoint read
+    # below is a direct memory-mapped load instead of a walk through the gzip stream.
+    # The copy goes next to the outputs, not the system temp dir (often a RAM-backed tmpfs)
+    tmp_path = None
+    if str(filepath).endswith('.gz'):
+        try:
+            tmp_dir = Path(filepath).parent if output_dir is None else Path(output_dir)
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = decompress_to_temp(filepath, tmp_dir)
+        except Exception as e:
+            print(f"Error loading file: {e}")
+            return None
     try:
-        img = nib.load(filepath)
-        data = img.get_fdata()
+        return _convert_nifti(filepath, tmp_path or filepath, n_preview, output_dir,
+                              dict(write_npy=write_npy, write_mat=write_mat, write_bytes=write_bytes,
+                                   write_unity_script=write_unity_script, compress=compress))
+    finally:
+        if tmp_path is not None:
+            os.remove(tmp_path)
+
+def decompress_to_temp(filepath, directory=None):
+    """
+    Stream-decompress a .nii.gz into a temporary .nii in directory and return its path
+    (the caller removes it). The extra full write only pays off when the fill can
+    use more than one thread; single-threaded, reading the .gz in order is as fast
+    """
+    with gzip.open(filepath, 'rb') as src, \
+            tempfile.NamedTemporaryFile(suffix='.nii', dir=directory, delete=False) as dst:
+        try:
+            shutil.copyfileobj(src, dst, 16 * 1024**2)
+        except BaseException:
+            dst.close()
+            os.remove(dst.name)
+            raise
+    return dst.name
+
+def _convert_nifti(filepath, source, n_preview, output_dir, write_flags):
+    """
+    Body of load_and_convert_nifti; voxel data is read from source, which is either
+    filepath itself or its decompressed temporary copy
+    """
+    
+    # Load the NIfTI file (header only; voxel data is read lazily through the array proxy)
+    try:
+        # mmap: per-timepoint reads of an uncompressed file are direct memmap slices;
+        # keep_file_open: reads of a compressed one continue from the open stream
+        img = nib.load(source, mmap=True, keep_file_open=True)
+        proxy = img.dataobj
         header = img.header
         affine = img.affine
         
         print(f"Successfully loaded: {Path(filepath).name}")
-        print(f"Original shape: {data.shape}")
-        print(f"Data type: {data.dtype}")
+        print(f"Original shape: {proxy.shape}")
+        print(f"Data type: {proxy.dtype}")
         print(f"Voxel dimensions: {header.get_zooms()}")
         
     except Exception as e:
@@ -34,43 +107,53 @@ def load_and_convert_nifti(filepath, n_preview=5, output_dir=None):
         return None
     
     # Check if it's 4D data
-    if len(data.shape) != 4:
-        print(f"Warning: Expected 4D data, got {len(data.shape)}D data with shape {data.shape}")
-        if len(data.shape) == 3:
+    shape = proxy.shape
+    if len(shape) != 4:
+        print(f"Warning: Expected 4D data, got {len(shape)}D data with shape {shape}")
+        if len(shape) == 3:
             print("Adding time dimension...")
-            data = data[:, :, :, np.newaxis]
+            shape = shape + (1,)
         else:
             print("Cannot process this data format.")
             return None
     
     # Get dimensions
-    x_size, y_size, z_size, t_size = data.shape
+    x_size, y_size, z_size, t_size = shape
     print(f"Spatial dimensions: {x_size} x {y_size} x {z_size}")
     print(f"Number of time points: {t_size}")
     
-    # Preview first n time slices
-    print(f"\n=== PREVIEW: First {min(n_preview, t_size)} time slices ===")
-    for t in range(min(n_preview, t_size)):
-        time_slice = data[:, :, :, t]
+    # Preview first n time slices (one read, per-timepoint stats as axis reductions)
+    n_show = min(n_preview, t_size)
+    print(f"\n=== PREVIEW: First {n_show} time slices ===")
+    if n_show > 0:
+        # Non-zero voxels are counted on the stored (typically int16) values, which is
+        # less data to scan than the float32 copy used for the other stats
+        raw = read_timepoints(proxy, 0, n_show, dtype=None)
+        if njit is not None:
+            # one fused pass per timepoint straight over the stored values
+            stats = np.array([fused_stats(raw[..., t]) for t in range(n_show)])
+            mins, maxs = stats[:, 0], stats[:, 1]
+            means = stats[:, 2] / (x_size * y_size * z_size)
+            nonzero = stats[:, 4].astype(np.int64)
+        else:
+            nonzero = np.count_nonzero(raw, axis=(0, 1, 2))
+            preview = raw.astype(np.float32, copy=False)
+            mins = preview.min(axis=(0, 1, 2))
+            maxs = preview.max(axis=(0, 1, 2))
+            means = preview.mean(axis=(0, 1, 2), dtype=np.float64)
+    for t in range(n_show):
         print(f"Time slice {t}:")
-        print(f"  Shape: {time_slice.shape}")
-        print(f"  Min: {np.min(time_slice):.3f}, Max: {np.max(time_slice):.3f}, Mean: {np.mean(time_slice):.3f}")
-        print(f"  Non-zero voxels: {np.count_nonzero(time_slice)}")
+        print(f"  Shape: {raw.shape[:3]}")
+        print(f"  Min: {mins[t]:.3f}, Max: {maxs[t]:.3f}, Mean: {means[t]:.3f}")
+        print(f"  Non-zero voxels: {nonzero[t]}")
         
         # Show a sample of values from the center of the volume
         center_x, center_y, center_z = x_size//2, y_size//2, z_size//2
-        sample_region = time_slice[center_x-2:center_x+3, center_y-2:center_y+3, center_z]
+        sample_region = raw[center_x-2:center_x+3, center_y-2:center_y+3, center_z, t].astype(np.float32)
         print(f"  Center slice sample (5x5 at z={center_z}):")
         print(f"    {sample_region}")
         print()
     
-    # Reshape to Unity format: (t, x, y, z)
-    print("Reshaping to Unity format (t, x, y, z)...")
-    unity_data = np.transpose(data, (3, 0, 1, 2))  # Move time dimension to front
-    
-    print(f"Unity format shape: {unity_data.shape}")
-    print(f"Memory usage: {unity_data.nbytes / (1024**2):.1f} MB")
-    
     # Set output directory
     if output_dir is None:
         output_dir = Path(filepath).parent
@@ -83,42 +166,158 @@ def load_and_convert_nifti(filepath, n_preview=5, output_dir=None):
     if input_name.endswith('.nii'):  # Handle .nii.gz files
         input_name = input_name[:-4]
     
-    # Save in multiple Unity-compatible formats
-    save_formats(unity_data, output_dir, input_name, header, affine)
+    # Reshape to Unity format (t, x, y, z) and save in multiple Unity-compatible formats
+    print("Reshaping to Unity format (t, x, y, z)...")
+    unity_data = save_formats(proxy, (t_size, x_size, y_size, z_size), output_dir, input_name, header, affine,
+                              **write_flags)
     
     return unity_data
 
-def save_formats(data, output_dir, filename_base, header, affine):
+def read_timepoints(proxy, start, stop, dtype=np.float32):
     """
-    Save 4D data in multiple formats compatible with Unity
+    Read timepoints [start, stop) of a 3D/4D NIfTI array proxy in a single slice,
+    as an (x, y, z, k) array of dtype. dtype=None keeps what nibabel returns: the
+    on-disk dtype (e.g. int16) when the image has no scl_slope/scl_inter to apply
+    """
+    if len(proxy.shape) == 3:
+        return np.asarray(proxy, dtype=dtype)[..., None]
+    return np.asarray(proxy[..., start:stop], dtype=dtype)
+
+def reorder_block(block, out, tile=(64, 16, 16), min_tiled_bytes=4 * 1024**2):
+    """
+    Copy an (x, y, z, k) block into out with shape (k, x, y, z), casting to out's dtype
+    (tile by tile over (x, y, z) for volumes larger than min_tiled_bytes)
+    """
+    src = np.moveaxis(block, -1, 0)
+    # x-fastest -> z-fastest reverses the spatial axes; past L2 size, tiling keeps each
+    # tile's reads and writes in cache, below it a single copy is faster
+    if out[0].nbytes < min_tiled_bytes:
+        np.copyto(out, src, casting='unsafe')
+        return out
+    X, Y, Z = block.shape[:3]
+    bx, by, bz = tile
+    for x0 in range(0, X, bx):
+        for y0 in range(0, Y, by):
+            for z0 in range(0, Z, bz):
+                t = np.s_[:, x0:x0 + bx, y0:y0 + by, z0:z0 + bz]
+                np.copyto(out[t], src[t], casting='unsafe')
+    return out
+
+def save_formats(proxy, shape, output_dir, filename_base, header, affine, write_npy=True,
+                 write_mat=False, write_bytes=True, write_unity_script=True, write_threads=None,
+                 time_block=8, compress=False):
+    """
+    Save 4D data in multiple formats compatible with Unity, streaming (t, x, y, z) float32
+    blocks from the NIfTI proxy; the JSON metadata is always written
+    
+    Parameters:
+    write_npy, write_mat, write_bytes, write_unity_script (bool): Which outputs to write
+    write_threads (int): Threads filling the output (default: up to 8)
+    time_block (int): Timepoints read from the proxy per block
+    compress (bool): Write the .npy data as a blosc2 .b2nd file instead (needs blosc2)
+    
+    Returns:
+    The array the data was written to: the .npy memmap, else the .bytes memmap, else the
+    .b2nd array, else an in-memory array
     """
     
     print(f"\nSaving files to: {output_dir}")
     
-    # 1. Save as NumPy binary format (.npy) - Recommended for Unity
-    npy_path = output_dir / f"{filename_base}_unity.npy"
-    np.save(npy_path, data)
-    print(f"✓ Saved NumPy format: {npy_path}")
+    zooms = header.get_zooms()
+    voxel_size = [float(x) for x in zooms[:3]]  # Convert to Python float
+    time_step = float(zooms[3]) if len(zooms) > 3 else 1.0
+    
+    if compress and blosc2 is None:
+        print("Warning: blosc2 is not installed; writing an uncompressed .npy instead")
+        compress = False
     
-    # 2. Save as MATLAB format (.mat) - Also compatible with Unity
+    npy_path = output_dir / f"{filename_base}_unity.npy"
+    b2nd_path = output_dir / f"{filename_base}_unity.b2nd"
     mat_path = output_dir / f"{filename_base}_unity.mat"
-    sio.savemat(mat_path, {
-        'fmri_data': data,
-        'shape': data.shape,
-        'data_info': {
-            'description': 'fMRI data in Unity format (t,x,y,z)',
-            'original_voxel_size': [float(x) for x in header.get_zooms()[:3]],  # Convert to Python float
-            'time_step': float(header.get_zooms()[3]) if len(header.get_zooms()) > 3 else 1.0
-        }
-    })
-    print(f"✓ Saved MATLAB format: {mat_path}")
+    bytes_path = output_dir / f"{filename_base}_unity.bytes"
+    
+    b2 = None
+    if compress and write_npy:
+        # LZ4 + byte shuffle, one chunk per timepoint; each block is compressed as soon as
+        # it is reordered, so the series is only held uncompressed if .bytes is written too
+        b2 = blosc2.empty(shape, dtype=np.float32, chunks=(1,) + tuple(shape[1:]),
+                          urlpath=str(b2nd_path), mode='w',
+                          cparams={'codec': blosc2.Codec.LZ4, 'filters': [blosc2.Filter.SHUFFLE]})
+        b2_lock = threading.Lock()  # blocks are compressed in parallel, appended one at a time
+    
+    # Output array: the .npy if requested, else the raw .bytes file itself, else the .b2nd;
+    # the other formats are written from it, so no transposed copy is held in memory
+    npy_sink = write_npy and not compress
+    if npy_sink:
+        data = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.float32, shape=shape)
+    elif write_bytes:
+        data = np.memmap(bytes_path, mode='w+', dtype=np.float32, shape=shape)
+    elif b2 is not None:
+        data = b2
+    else:
+        data = np.empty(shape, dtype=np.float32)
+    
+    if write_threads is None:
+        write_threads = min(8, os.cpu_count() or 1)
+    if str(getattr(proxy, 'file_like', '')).endswith('.gz'):
+        # gzip can't seek backwards: out-of-order reads would restart decompression each time
+        write_threads = 1
+    
+    # blocks are capped at ~256 MB of float32
+    frame_bytes = max(1, int(np.prod(shape[1:])) * 4)
+    time_block = max(1, min(int(time_block), (256 * 1024**2) // frame_bytes))
+    
+    def fill(t0):
+        # one proxy read per block (scaling applied to the whole block), cast into out[t0:t1]
+        block = read_timepoints(proxy, t0, t0 + time_block, dtype=None)
+        t1 = t0 + block.shape[-1]
+        if b2 is None:
+            reorder_block(block, data[t0:t1])
+            return
+        # compressed: reorder into the .bytes slab when there is one, else a scratch block
+        out = data[t0:t1] if data is not b2 else np.empty((t1 - t0,) + tuple(shape[1:]), np.float32)
+        reorder_block(block, out)
+        with b2_lock:
+            b2[t0:t1] = out
+    
+    starts = range(0, shape[0], time_block)
+    if write_threads > 1:
+        with ThreadPoolExecutor(max_workers=write_threads) as ex:
+            list(ex.map(fill, starts))
+    else:
+        for t0 in starts:
+            fill(t0)
+    if isinstance(data, np.memmap):
+        data.flush()
+    print(f"Unity format shape: {data.shape}")
+    print(f"Memory usage: {data.nbytes / (1024**2):.1f} MB")
+    
+    # 1. Save as NumPy binary format (.npy) - Recommended for Unity
+    if b2 is not None:
+        print(f"✓ Saved compressed format: {b2nd_path}")
+    elif write_npy:
+        print(f"✓ Saved NumPy format: {npy_path}")
+    
+    # 2. Save as MATLAB format (.mat) - Also compatible with Unity (optional)
+    if write_mat:
+        sio.savemat(mat_path, {
+            'fmri_data': data if isinstance(data, np.ndarray) else data[:],
+            'shape': data.shape,
+            'data_info': {
+                'description': 'fMRI data in Unity format (t,x,y,z)',
+                'original_voxel_size': voxel_size,
+                'time_step': time_step
+            }
+        }, do_compression=False)
+        print(f"✓ Saved MATLAB format: {mat_path}")
     
     # 3. Save as raw binary (.bytes) - Direct binary format for Unity
-    bytes_path = output_dir / f"{filename_base}_unity.bytes"
-    # Convert to float32 for Unity compatibility and save as binary
-    data_float32 = data.astype(np.float32)
-    data_float32.tofile(bytes_path)
-    print(f"✓ Saved binary format: {bytes_path}")
+    if write_bytes:
+        if npy_sink:
+            # Already float32 (what Unity expects): the .npy payload is exactly the .bytes
+            # file, so copy it past the header without going through Python buffers
+            copy_payload(npy_path, bytes_path, data.offset, data.nbytes)
+        print(f"✓ Saved binary format: {bytes_path}")
     
     # 4. Save metadata as JSON for Unity scripts
     json_path = output_dir / f"{filename_base}_metadata.json"
@@ -131,38 +330,131 @@ def save_formats(data, output_dir, filename_base, header, affine):
             'y': int(data.shape[2]),
             'z': int(data.shape[3])
         },
-        'voxel_size': [float(x) for x in header.get_zooms()[:3]],  # FIX: Convert to Python float
-        'time_step': float(header.get_zooms()[3]) if len(header.get_zooms()) > 3 else 1.0,
+        'voxel_size': voxel_size,
+        'time_step': time_step,
         'file_info': {
-            'npy_file': f"{filename_base}_unity.npy",
-            'mat_file': f"{filename_base}_unity.mat", 
-            'bytes_file': f"{filename_base}_unity.bytes",
+            'npy_file': npy_path.name if npy_sink else None,
+            'b2nd_file': b2nd_path.name if b2 is not None else None,
+            'mat_file': mat_path.name if write_mat else None,
+            'bytes_file': bytes_path.name if write_bytes else None,
             'format_note': 'Data is in (t,x,y,z) format - time first, then spatial dimensions'
         },
-        'data_stats': {
-            'min': float(np.min(data)),
-            'max': float(np.max(data)),
-            'mean': float(np.mean(data)),
-            'std': float(np.std(data))
-        }
+        # NaN/inf stats are stored as null: orjson and json would otherwise disagree (null vs NaN)
+        'data_stats': {k: (v if np.isfinite(v) else None)
+                       for k, v in zip(('min', 'max', 'mean', 'std'), _stats4(data))}
     }
     
-    with open(json_path, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    if orjson is not None:
+        with open(json_path, 'wb') as f:
+            f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(json_path, 'w') as f:
+            json.dump(metadata, f, indent=2)
     print(f"✓ Saved metadata: {json_path}")
     
-    # 5. Create Unity C# script template
-    create_unity_loader_script(output_dir, filename_base, data.shape)
+    # 5. Create Unity C# script template (it loads the .bytes file, so only alongside one)
+    if write_unity_script and not write_bytes:
+        print("Skipping Unity C# script: it reads the .bytes file, which was not written")
+    elif write_unity_script:
+        create_unity_loader_script(output_dir, filename_base, data.shape)
+    
+    return data
+
+def copy_payload(src_path, dst_path, offset, nbytes):
+    """
+    Copy nbytes starting at offset of src_path into a new dst_path, in kernel space
+    with os.copy_file_range where available (Linux), else with a bounded read/write loop
+    """
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                done = 0
+                while done < nbytes:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), nbytes - done,
+                                           offset + done, done)
+                    if n == 0:
+                        break
+                    done += n
+                if done == nbytes:
+                    return
+            except OSError:
+                pass  # e.g. cross-filesystem on older kernels; redo it the portable way
+            dst.seek(0)
+            dst.truncate()
+        src.seek(offset)
+        remaining = nbytes
+        while remaining > 0:
+            buf = src.read(min(remaining, 16 * 1024**2))
+            if not buf:
+                break
+            dst.write(buf)
+            remaining -= len(buf)
+
+if njit is not None:
+    # no fastmath: it would let LLVM assume there are no NaNs, and NaN voxels must count
+    # as non-zero and poison min/max exactly like the NumPy fallback
+    @njit(parallel=True, cache=True)
+    def _fused_stats_kernel(flat):
+        mn = np.inf
+        mx = -np.inf
+        s = 0.0
+        s2 = 0.0
+        nz = 0
+        n_nan = 0
+        for i in prange(flat.size):
+            v = np.float64(flat[i])
+            mn = min(mn, v)
+            mx = max(mx, v)
+            s += v
+            s2 += v * v
+            nz += v != 0.0
+            n_nan += v != v
+        if n_nan > 0:  # min()/max() skip NaN, np.min/np.max propagate it
+            mn = np.nan
+            mx = np.nan
+        return mn, mx, s, s2, nz
+
+def fused_stats(a):
+    """
+    (min, max, sum, sum of squares, non-zero count) of a in a single pass, with float64
+    accumulators; a parallel numba kernel when numba is installed
+    """
+    flat = np.ravel(a, order='K')  # any memory order will do, so contiguous input isn't copied
+    if njit is not None:
+        return _fused_stats_kernel(flat)
+    f = flat.astype(np.float64)
+    return f.min(), f.max(), f.sum(), np.dot(f, f), np.count_nonzero(flat)
+
+def _stats4(a, block_bytes=64 * 1024**2):
+    """
+    min, max, mean and std of a (t, ...) array in one pass over blocks of timepoints,
+    accumulating sum and sum of squares in float64
+    """
+    frame_bytes = max(1, a[0].nbytes) if len(a) else 1
+    step = max(1, block_bytes // frame_bytes)
+    mn, mx, s, s2, n = np.inf, -np.inf, 0.0, 0.0, 0
+    for t0 in range(0, len(a), step):
+        blk = a[t0:t0 + step]
+        b_mn, b_mx, b_s, b_s2, _ = fused_stats(blk)
+        mn = np.minimum(mn, b_mn)  # np.minimum/maximum carry a NaN through, min()/max() drop it
+        mx = np.maximum(mx, b_mx)
+        s += b_s
+        s2 += b_s2
+        n += blk.size
+    mean = s / n
+    return float(mn), float(mx), float(mean), float(np.sqrt(max(s2 / n - mean * mean, 0.0)))
 
 def create_unity_loader_script(output_dir, filename_base, shape):
     """
     Create a Unity C# script template for loading the fMRI data
     """
     
-    script_content = f'''using System.Collections;
+    script_content = f'''using System;
+using System.Collections;
 using System.Collections.Generic;
 using UnityEngine;
 using System.IO;
+using System.IO.MemoryMappedFiles;
 
 public class FMRILoader : MonoBehaviour
 {{
@@ -174,7 +466,8 @@ public class FMRILoader : MonoBehaviour
     public int zSize = {shape[3]};
     
     [Header("Runtime Data")]
-    public float[,,,] fmriData;
+    // Flat (t, x, y, z) data in file order; index with ((t*xSize + x)*ySize + y)*zSize + z
+    public float[] fmriData;
     public bool dataLoaded = false;
     
     void Start()
@@ -188,28 +481,15 @@ public class FMRILoader : MonoBehaviour
         
         if (File.Exists(filePath))
         {{
-            byte[] fileBytes = File.ReadAllBytes(filePath);
-            float[] floatArray = new float[fileBytes.Length / 4];
-            
-            Buffer.BlockCopy(fileBytes, 0, floatArray, 0, fileBytes.Length);
+            int totalFloats = (int)(new FileInfo(filePath).Length / sizeof(float));
+            fmriData = new float[totalFloats];
             
-            // Initialize 4D array
-            fmriData = new float[timePoints, xSize, ySize, zSize];
-            
-            // Fill the 4D array
-            int index = 0;
-            for (int t = 0; t < timePoints; t++)
+            // The file is already laid out as (t, x, y, z): map it and read it straight into
+            // the array, without staging the whole file in a byte[] first
+            using (var mmf = MemoryMappedFile.CreateFromFile(filePath, FileMode.Open, null, 0, MemoryMappedFileAccess.Read))
+            using (var accessor = mmf.CreateViewAccessor(0, (long)totalFloats * sizeof(float), MemoryMappedFileAccess.Read))
             {{
-                for (int x = 0; x < xSize; x++)
-                {{
-                    for (int y = 0; y < ySize; y++)
-                    {{
-                        for (int z = 0; z < zSize; z++)
-                        {{
-                            fmriData[t, x, y, z] = floatArray[index++];
-                        }}
-                    }}
-                }}
+                accessor.ReadArray(0, fmriData, 0, totalFloats);
             }}
             
             dataLoaded = true;
@@ -231,16 +511,23 @@ public class FMRILoader : MonoBehaviour
             return 0f;
         }}
         
-        return fmriData[timePoint, x, y, z];
+        return fmriData[((timePoint * xSize + x) * ySize + y) * zSize + z];
     }}
     
     // Get entire time series for a voxel
     public float[] GetVoxelTimeSeries(int x, int y, int z)
     {{
         float[] timeSeries = new float[timePoints];
-        for (int t = 0; t < timePoints; t++)
+        if (!dataLoaded || x < 0 || y < 0 || z < 0 || x >= xSize || y >= ySize || z >= zSize)
+        {{
+            return timeSeries;
+        }}
+        
+        int volumeSize = xSize * ySize * zSize;
+        int index = (x * ySize + y) * zSize + z;
+        for (int t = 0; t < timePoints; t++, index += volumeSize)
         {{
-            timeSeries[t] = GetVoxelValue(t, x, y, z);
+            timeSeries[t] = fmriData[index];
         }}
         return timeSeries;
     }}
@@ -249,16 +536,14 @@ public class FMRILoader : MonoBehaviour
     public float[,,] GetTimeSlice(int timePoint)
     {{
         float[,,] timeSlice = new float[xSize, ySize, zSize];
-        for (int x = 0; x < xSize; x++)
+        if (!dataLoaded || timePoint < 0 || timePoint >= timePoints)
         {{
-            for (int y = 0; y < ySize; y++)
-            {{
-                for (int z = 0; z < zSize; z++)
-                {{
-                    timeSlice[x, y, z] = GetVoxelValue(timePoint, x, y, z);
-                }}
-            }}
+            return timeSlice;
         }}
+        
+        // A time slice is one contiguous block of the flat array, in the same (x, y, z) order
+        int volumeBytes = xSize * ySize * zSize * sizeof(float);
+        Buffer.BlockCopy(fmriData, timePoint * volumeBytes, timeSlice, 0, volumeBytes);
         return timeSlice;
     }}
 }}
@@ -276,9 +561,16 @@ def load_unity_format(filepath):
     print(f"Loading Unity format data from: {filepath}")
     
     if filepath.endswith('.npy'):
-        data = np.load(filepath)
+        # memory-mapped: only the header is read here, the payload is paged in on access
+        data = np.load(filepath, mmap_mode='r')
+    elif filepath.endswith('.b2nd'):
+        if blosc2 is None:
+            print("Loading .b2nd files requires the blosc2 package")
+            return None
+        # blosc2 NDArray: chunks are decompressed when indexed
+        data = blosc2.open(filepath)
     elif filepath.endswith('.mat'):
-        mat_data = sio.loadmat(filepath)
+        mat_data = sio.loadmat(filepath, variable_names=['fmri_data'])
         data = mat_data['fmri_data']
     else:
         print("Unsupported format for loading")
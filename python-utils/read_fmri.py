@@ -1,9 +1,48 @@
 import nibabel as nib
 import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
 
-def load_and_display_nifti(filepath, slice_coords=None):
+# matplotlib is imported where a figure is built, so PNG-only exports (output_png) skip
+# its import and backend startup; PIL is only needed for those exports
+
+def read_plane(dobj, index):
+    """
+    Read index (a 3D slicing tuple) from the first volume of a 3D/4D NIfTI array proxy as float32
+    """
+    if len(dobj.shape) == 4:
+        index = index + (0,)
+    return np.asarray(dobj[index], dtype=np.float32)
+
+def print_image_stats(dobj):
+    """
+    Print min/max/mean/std of the first volume, on every 4th voxel along each axis
+    """
+    sample = read_plane(dobj, np.s_[::4, ::4, ::4])
+    print(f"\nImage statistics (sampled every 4th voxel):")
+    print(f"Min value: {np.min(sample):.3f}")
+    print(f"Max value: {np.max(sample):.3f}")
+    print(f"Mean value: {np.mean(sample, dtype=np.float64):.3f}")
+    print(f"Std deviation: {np.std(sample, dtype=np.float64):.3f}")
+
+def save_slices_png(slices, output_png):
+    """
+    Write (sagittal, coronal, axial) slices as 8-bit grayscale PNGs named
+    {output_png}_sag.png, _cor.png and _ax.png, each min/max normalized and oriented
+    like the viewer (second axis pointing up). Returns the written paths.
+    """
+    from PIL import Image
+    
+    paths = []
+    for plane, suffix in zip(slices, ('sag', 'cor', 'ax')):
+        mn, mx = float(plane.min()), float(plane.max())
+        scale = 255.0 / (mx - mn) if mx > mn else 0.0
+        u8 = ((plane - mn) * scale + 0.5).astype(np.uint8)
+        path = f"{output_png}_{suffix}.png"
+        Image.fromarray(np.ascontiguousarray(u8.T[::-1]), 'L').save(path)
+        paths.append(path)
+    return paths
+
+def load_and_display_nifti(filepath, slice_coords=None, show=True, output_png=None):
     """
     Load and display a NIfTI file in standard 3-slice view (sagittal, coronal, axial)
     
@@ -11,26 +50,33 @@ def load_and_display_nifti(filepath, slice_coords=None):
     filepath (str): Path to the .nii or .nii.gz file
     slice_coords (tuple): (x, y, z) coordinates for slice positions. 
                          If None, uses center of the image.
+    show (bool): Call plt.show() (blocking) before returning
+    output_png (str): If given, skip matplotlib and write the three slices as PNGs
+                      ({output_png}_sag.png, _cor.png, _ax.png) with PIL instead
+    
+    Returns:
+    tuple: (fig, (im1, im2, im3), dataobj) - the figure, its sagittal/coronal/axial images
+           and the image's array proxy, for updating the view with update_slices
+           (with output_png: the list of written PNG paths)
     """
     
-    # Load the NIfTI file
+    # Load the NIfTI file (header only; slices are read lazily through the array proxy)
     try:
-        img = nib.load(filepath)
-        data = img.get_fdata()
-        print(f"Loaded image with shape: {data.shape}")
-        print(f"Image data type: {data.dtype}")
+        img = nib.load(filepath, keep_file_open=True)
+        dobj = img.dataobj
+        print(f"Loaded image with shape: {dobj.shape}")
+        print(f"Image data type: {dobj.dtype}")
         print(f"Voxel dimensions: {img.header.get_zooms()}")
     except Exception as e:
         print(f"Error loading file: {e}")
         return
     
     # Handle 4D data (take first volume if it's a time series)
-    if len(data.shape) == 4:
-        print(f"4D data detected with {data.shape[3]} volumes. Using first volume.")
-        data = data[:, :, :, 0]
+    if len(dobj.shape) == 4:
+        print(f"4D data detected with {dobj.shape[3]} volumes. Using first volume.")
     
     # Get image dimensions
-    x_size, y_size, z_size = data.shape
+    x_size, y_size, z_size = dobj.shape[:3]
     
     # Set slice coordinates (center of brain if not specified)
     if slice_coords is None:
@@ -48,9 +94,17 @@ def load_and_display_nifti(filepath, slice_coords=None):
     z_slice = max(0, min(z_slice, z_size - 1))
     
     # Extract the three orthogonal slices
-    sagittal_slice = data[x_slice, :, :]  # YZ plane (left-right view)
-    coronal_slice = data[:, y_slice, :]   # XZ plane (front-back view)
-    axial_slice = data[:, :, z_slice]     # XY plane (top-bottom view)
+    sagittal_slice = read_plane(dobj, np.s_[x_slice, :, :])  # YZ plane (left-right view)
+    coronal_slice = read_plane(dobj, np.s_[:, y_slice, :])   # XZ plane (front-back view)
+    axial_slice = read_plane(dobj, np.s_[:, :, z_slice])     # XY plane (top-bottom view)
+    
+    if output_png is not None:
+        paths = save_slices_png((sagittal_slice, coronal_slice, axial_slice), output_png)
+        print(f"Saved slices: {', '.join(paths)}")
+        print_image_stats(dobj)
+        return paths
+    
+    import matplotlib.pyplot as plt
     
     # Create the figure with subplots
     fig, axes = plt.subplots(1, 3, figsize=(15, 5))
@@ -88,43 +142,82 @@ def load_and_display_nifti(filepath, slice_coords=None):
     
     # Adjust layout and display
     plt.tight_layout()
-    plt.show()
+    if show:
+        plt.show()
     
     # Print some basic statistics
-    print(f"\nImage statistics:")
-    print(f"Min value: {np.min(data):.3f}")
-    print(f"Max value: {np.max(data):.3f}")
-    print(f"Mean value: {np.mean(data):.3f}")
-    print(f"Std deviation: {np.std(data):.3f}")
+    print_image_stats(dobj)
+    
+    return fig, (im1, im2, im3), dobj
+
+def update_slices(fig, images, dobj, slice_coords, name):
+    """
+    Move an existing 3-slice view to new (x, y, z) coordinates in place: reads the three
+    planes from the proxy and swaps them into the images instead of rebuilding the figure
+    (name is the file name shown in the figure title)
+    """
+    x_size, y_size, z_size = dobj.shape[:3]
+    x_slice, y_slice, z_slice = slice_coords
+    x_slice = max(0, min(x_slice, x_size - 1))
+    y_slice = max(0, min(y_slice, y_size - 1))
+    z_slice = max(0, min(z_slice, z_size - 1))
+    
+    im1, im2, im3 = images
+    im1.set_data(read_plane(dobj, np.s_[x_slice, :, :]).T)
+    im2.set_data(read_plane(dobj, np.s_[:, y_slice, :]).T)
+    im3.set_data(read_plane(dobj, np.s_[:, :, z_slice]).T)
+    
+    # Titles and crosshairs (each axes holds its axhline, then its axvline)
+    for im, title, (h, v) in ((im1, f'Sagittal (X={x_slice})', (z_slice, y_slice)),
+                              (im2, f'Coronal (Y={y_slice})', (z_slice, x_slice)),
+                              (im3, f'Axial (Z={z_slice})', (y_slice, x_slice))):
+        im.autoscale()
+        im.axes.set_title(title)
+        hline, vline = im.axes.lines[:2]
+        hline.set_ydata([h, h])
+        vline.set_xdata([v, v])
+    
+    fig.suptitle(f'NIfTI Viewer: {name}\nSlice coordinates: ({x_slice}, {y_slice}, {z_slice})', 
+                 fontsize=14, fontweight='bold')
+    fig.canvas.draw_idle()
 
 def interactive_viewer(filepath):
     """
     Simple interactive viewer that allows you to specify slice coordinates
+    
+    The file is loaded and the figure built once; each new set of coordinates only
+    reads three planes and redraws the existing images.
     """
-    img = nib.load(filepath)
-    data = img.get_fdata()
+    import matplotlib.pyplot as plt
     
-    if len(data.shape) == 4:
-        data = data[:, :, :, 0]
+    result = load_and_display_nifti(filepath, show=False)
+    if result is None:
+        return
+    fig, images, dobj = result
     
-    x_size, y_size, z_size = data.shape
+    x_size, y_size, z_size = dobj.shape[:3]
     print(f"Image dimensions: {x_size} x {y_size} x {z_size}")
-    print("Enter slice coordinates (or press Enter for center):")
+    plt.ion()
+    plt.show()
     
-    try:
+    while plt.fignum_exists(fig.number):
+        print("Enter slice coordinates (or press Enter for center, q to quit):")
         x_input = input(f"X coordinate (0-{x_size-1}): ").strip()
+        if x_input.lower() == 'q':
+            break
         y_input = input(f"Y coordinate (0-{y_size-1}): ").strip()
         z_input = input(f"Z coordinate (0-{z_size-1}): ").strip()
         
-        x_slice = int(x_input) if x_input else x_size // 2
-        y_slice = int(y_input) if y_input else y_size // 2
-        z_slice = int(z_input) if z_input else z_size // 2
-        
-        load_and_display_nifti(filepath, (x_slice, y_slice, z_slice))
+        try:
+            x_slice = int(x_input) if x_input else x_size // 2
+            y_slice = int(y_input) if y_input else y_size // 2
+            z_slice = int(z_input) if z_input else z_size // 2
+        except ValueError:
+            print("Invalid input. Using center coordinates.")
+            x_slice, y_slice, z_slice = x_size // 2, y_size // 2, z_size // 2
         
-    except ValueError:
-        print("Invalid input. Using center coordinates.")
-        load_and_display_nifti(filepath)
+        update_slices(fig, images, dobj, (x_slice, y_slice, z_slice), Path(filepath).name)
+        plt.pause(0.001)  # let the GUI event loop process the redraw
 
 # Example usage
 if __name__ == "__main__":